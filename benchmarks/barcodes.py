@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# Compare the barcode extractor with the old one on a corpus of email bodies,
+# one plain text file per ticket, e.g. exported with Tracker.get_plain_text_content.
+#
+# Usage: python benchmarks/barcodes.py CORPUS_DIR [--repeat N]
+import argparse
+import glob
+import os
+import re
+import time
+
+from rtbot.barcodes import extract_barcodes
+
+
+def extract_barcodes_old(content):
+    barcodes = re.findall(r'\b[0-9a-zA-Z]{9}\b', content)
+    barcodes = set([x for x in barcodes if re.search(r'[0-9]{4}', x)])
+    for barcode in re.findall(r'\bRS-47BIBSYSUBO[0-9]+\b', content):
+        barcodes.add(barcode)
+    return barcodes
+
+
+def measure(fn, bodies, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        candidates = sum(len(fn(body)) for body in bodies)
+    return candidates, (time.perf_counter() - t0) / repeat * 1000
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('corpus')
+parser.add_argument('--repeat', type=int, default=10)
+args = parser.parse_args()
+
+bodies = []
+for filename in sorted(glob.glob(os.path.join(args.corpus, '*.txt'))):
+    with open(filename, encoding='utf-8') as fp:
+        bodies.append(fp.read())
+
+print('%d email bodies' % len(bodies))
+for name, fn in [('old', extract_barcodes_old), ('new', extract_barcodes)]:
+    candidates, ms = measure(fn, bodies, args.repeat)
+    print('%s: %d candidates (= Alma lookups), %.1f ms' % (name, candidates, ms))
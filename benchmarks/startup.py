@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# Measure how long it takes to import rtbot.bot and load the enabled processors,
+# which is what every cron-started run pays before doing any work.
+#
+# Usage: python benchmarks/startup.py [--runs N] [--max-ms MS]
+# Exits with status 1 if the median time is above --max-ms.
+import argparse
+import statistics
+import subprocess
+import sys
+
+CODE = '''
+import time
+t0 = time.perf_counter()
+import rtbot.bot
+from rtbot.processors import processors, load_processor
+for name in processors:
+    load_processor(name)
+print((time.perf_counter() - t0) * 1000)
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--runs', type=int, default=10)
+parser.add_argument('--max-ms', type=float, default=None)
+args = parser.parse_args()
+
+times = []
+for _ in range(args.runs):
+    out = subprocess.run([sys.executable, '-c', CODE], check=True, capture_output=True, text=True)
+    times.append(float(out.stdout.strip().splitlines()[-1]))
+
+median = statistics.median(times)
+print('Startup time: median %.1f ms, min %.1f ms, max %.1f ms (%d runs)' % (median, min(times), max(times), args.runs))
+
+if args.max_ms is not None and median > args.max_ms:
+    print('Startup time is above the limit of %.1f ms' % args.max_ms)
+    sys.exit(1)
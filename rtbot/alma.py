@@ -1,8 +1,18 @@
 import json
 import logging
 import os
+import threading
+import time
 import requests
 import functools
+from urllib.parse import quote
+from .ratelimit import TokenBucket, limit_session
+from .cache import Cache, default_path
+from .breaker import CircuitBreaker
+from .quota import Quota, QuotaExhausted
+from .singleflight import SingleFlight
+from .itemindex import ItemIndex
+from .userindex import UserIndex
 
 log = logging.getLogger(__name__)
 
@@ -11,29 +21,148 @@ DEFAULT_TIMEOUT = 30
 ALMA_URL = 'https://api-eu.hosted.exlibrisgroup.com/almaws/v1'
 
 
+def is_not_found(data):
+    return bool(data.get('errorsExist')) or str(data.get('total_record_count')) == '0'
+
+
 class Alma(object):
 
     def __init__(self):
-        # Create a session for Alma requests, with a default timeout and headers
-        self.session = requests.Session()
-        self.session.get = functools.partial(self.session.get, timeout=DEFAULT_TIMEOUT)
-        self.session.headers = {
-            'Accept': 'application/json',
-            'Authorization': 'apikey %s' % os.getenv('ALMA_KEY'),
+        self.limiter = TokenBucket.from_env('ALMA', 10, 20)
+        self.full_rate = self.limiter.rate
+        # After a 429 response, stay at the lower rate for this many seconds
+        self.throttle_cooldown = float(os.getenv('ALMA_THROTTLE_COOLDOWN', 60))
+        self.throttled_until = 0
+        self.local = threading.local()
+
+        # Fail fast while Alma is down, instead of waiting for timeouts on every call
+        self.breaker = CircuitBreaker.from_env('ALMA')
+
+        # Lookups made during the current run, shared by all tickets
+        self.lookups = SingleFlight()
+
+        # Keep track of our share of the API quota, and slow down as it runs low
+        self.quota = Quota(default_path() or ':memory:',
+                           low=int(os.getenv('ALMA_QUOTA_LOW', 10000)),
+                           critical=int(os.getenv('ALMA_QUOTA_CRITICAL', 1000)))
+
+        # Optional local barcode index, created with `rtbot --import-items`
+        item_index_path = os.getenv('ALMA_ITEM_INDEX', 'alma_items.db')
+        self.item_index = ItemIndex(item_index_path) if os.path.exists(item_index_path) else None
+
+        # Optional local user table, created with `rtbot --import-users`
+        user_index_path = os.getenv('ALMA_USER_INDEX', 'alma_users.db')
+        self.user_index = UserIndex(user_index_path) if os.path.exists(user_index_path) else None
+        self.cache = Cache('alma', maxsize=5000, path=default_path())
+
+        # Cache lifetimes in seconds per endpoint, for records found and not found
+        self.cache_ttl = {
+            'users': (int(os.getenv('ALMA_CACHE_TTL_USERS', 6 * 3600)), 3600),
+            'items': (int(os.getenv('ALMA_CACHE_TTL_ITEMS', 7 * 86400)), 3600),
         }
 
+    @property
+    def session(self):
+        # Create a session for Alma requests, with a default timeout and headers.
+        # Sessions are not thread-safe, so each worker thread gets its own.
+        if not hasattr(self.local, 'session'):
+            session = limit_session(requests.Session(), self.limiter)
+            session.get = functools.partial(session.get, timeout=DEFAULT_TIMEOUT)
+            session.headers = {
+                'Accept': 'application/json',
+                'Authorization': 'apikey %s' % os.getenv('ALMA_KEY'),
+            }
+            self.local.session = session
+        return self.local.session
+
     def get_session(self):
         return self.session
 
     def get(self, url, **kwargs):
-        return self.session.get(ALMA_URL + '/' + url.lstrip('/'), **kwargs)
+        if self.quota.is_exhausted():
+            raise QuotaExhausted('Only %d Alma API calls left today' % self.quota.remaining)
+
+        res = self.breaker.call(self.session.get, ALMA_URL + '/' + url.lstrip('/'), **kwargs)
+        self.quota.record(url.lstrip('/').split('/')[0], res)
+        self.throttle(res)
+        return res
+
+    def throttle(self, res):
+        # Slow down to a quarter of the normal rate when the daily quota runs low, or for a
+        # while after Alma says we are over the per-second limit. get_json() raises on the
+        # 429 itself, so the call is retried at the lower rate.
+        now = time.monotonic()
+        if res.status_code == 429:
+            self.throttled_until = now + self.throttle_cooldown
+        rate = self.full_rate
+        if self.quota.is_low() or now < self.throttled_until:
+            rate = self.full_rate / 4
+        if rate != self.limiter.rate:
+            log.warning('Setting the Alma rate limit to %.1f calls per second (remaining quota: %s)',
+                        rate, self.quota.remaining)
+            self.limiter.rate = rate
 
     def get_json(self, url, **kwargs):
+        endpoint = url.lstrip('/').split('/')[0]
+        # Fees and blocks are reported to staff as they are now, so they are never cached
+        cacheable = endpoint in self.cache_ttl and 'fees' not in (kwargs.get('params') or {}).get('expand', '')
+        if cacheable:
+            cache_key = url + '?' + json.dumps(kwargs.get('params'), sort_keys=True)
+            data = self.cache.get(cache_key)
+            if data is not None:
+                return data
+
         res = self.get(url, **kwargs)
+        if not (res.ok or res.status_code in (400, 404)):
+            # Throttling and server errors are not answers. Raise, so that the call is
+            # retried or the ticket deferred, instead of reading them as "not found".
+            res.raise_for_status()
 
         try:
-            return res.json()
+            data = res.json()
         except json.decoder.JSONDecodeError:
             log.error('Could not decode JSON: %s', res.text)
             raise
 
+        if cacheable:
+            ttl, not_found_ttl = self.cache_ttl[endpoint]
+            self.cache.set(cache_key, data, not_found_ttl if is_not_found(data) else ttl)
+
+        return data
+
+    def start_run(self):
+        self.lookups.clear()
+
+    def get_item(self, barcode):
+        # Return the item_data of an item, or None if not found. Only looked up once per run.
+        return self.lookups.do(('item', barcode), self.lookup_item, barcode)
+
+    def lookup_item(self, barcode):
+        # Look up an item in the local index if possible, or else in Alma
+        if self.item_index is not None:
+            item_data = self.item_index.lookup(barcode)
+            if item_data is not None:
+                return item_data
+        return self.get_json('/items', params={'item_barcode': barcode}).get('item_data')
+
+    def find_user(self, email):
+        # Return the user record of the first user with a matching email address, or None
+        # if not found. Only looked up once per run.
+        return self.lookups.do(('user', email), self.lookup_user, email)
+
+    def lookup_user(self, email):
+        # Look up a user in the local user table if possible, or else in Alma
+        if self.user_index is not None:
+            user_data = self.user_index.lookup(email)
+            if user_data is not None:
+                return user_data
+
+        search_results = self.get_json('/users', params={
+            'q': 'email~%s' % email,
+            'limit': 10,
+            'offset': 0,
+        })
+        if search_results['total_record_count'] == 0:
+            return None
+        primary_id = search_results['user'][0]['primary_id']
+        return self.get_json('/users/%s' % quote(primary_id))
@@ -0,0 +1,36 @@
+import os
+import re
+
+# Resource sharing request ids, or 9 character tokens that may be item barcodes
+TOKEN_RE = re.compile(r'\b(?:(RS-47BIBSYSUBO[0-9]+)|([0-9a-zA-Z]{9}))\b')
+
+# Our item barcodes: two digits, two digits or letters, and five digits (e.g. 03tf05418)
+BARCODE_RE = re.compile(r'^[0-9]{2}(?:[0-9]{2}|[a-z]{2}|[A-Z]{2}|[0-9][a-zA-Z]|[a-zA-Z][0-9])[0-9]{5}$')
+
+FOUR_DIGITS_RE = re.compile(r'[0-9]{4}')
+
+
+def score_barcode(token):
+    # 2: matches the structure of our barcodes
+    # 1: has four digits in a row, which is all the old extractor required
+    # 0: not a plausible barcode
+    if BARCODE_RE.match(token):
+        return 2
+    if FOUR_DIGITS_RE.search(token):
+        return 1
+    return 0
+
+
+def extract_barcodes(content, min_score=None):
+    # Find resource sharing ids and plausible item barcodes in a single scan of the text.
+    # Candidates scoring below min_score (BARCODE_MIN_SCORE, default 2) are skipped.
+    if min_score is None:
+        min_score = int(os.getenv('BARCODE_MIN_SCORE', 2))
+    barcodes = []
+    for m in TOKEN_RE.finditer(content):
+        token = m.group(1) or m.group(2)
+        if token in barcodes:
+            continue
+        if m.group(1) is not None or score_barcode(token) >= min_score:
+            barcodes.append(token)
+    return barcodes
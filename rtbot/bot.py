@@ -1,21 +1,40 @@
 # settings.py
-import yaml
-import time
-import logging.config
+import os
+import random
+import signal
+import threading
+import argparse
+import logging
 import requests
 import rt
 import backoff
-from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
 from .alma import Alma
 from .rt import Tracker
 from .processors import get_processors
+from .pipeline import Pipeline
+from .watermark import Watermarks
+from .cache import default_path
+from .itemindex import ItemIndex
+from .userindex import UserIndex
+from .memo import DecisionMemo
+from .breaker import CircuitOpen
+
 
-with open('logging.yml') as fp:
-    logging.config.dictConfig(yaml.load(fp, Loader=yaml.SafeLoader))
 log = logging.getLogger(__name__)
 
-# Load environment variables from a .env file
-load_dotenv()
+
+def setup_logging():
+    import yaml
+    import logging.config
+    with open('logging.yml') as fp:
+        logging.config.dictConfig(yaml.load(fp, Loader=yaml.SafeLoader))
+
+
+def load_settings(override=False):
+    # Load environment variables from a .env file
+    from dotenv import load_dotenv
+    load_dotenv(override=override)
 
 exceptions = (
     requests.exceptions.Timeout,
@@ -27,24 +46,219 @@ exceptions = (
 
 @backoff.on_exception(backoff.expo, exceptions, max_tries=10)
 def process_ticket(processor, ticket):
-    processor.process_ticket(ticket)
+    try:
+        result = processor.process_ticket(ticket)
+    except Exception:
+        # Drop half-made changes, so that a retry does not add them twice
+        processor.rt.discard(ticket['id'])
+        raise
+    # Write the changes the processor made, if any
+    processor.rt.submit(ticket['id'])
+    return result
 
 
 @backoff.on_exception(backoff.expo, exceptions, max_tries=10)
 def process_tickets(processor):
     for ticket in processor.get_tickets():
-        time.sleep(1)
-        process_ticket(processor, ticket)
+        try:
+            process_ticket(processor, ticket)
+        except CircuitOpen as e:
+            log.warning('[#%s] Skipping ticket: %s', ticket['id'], e)
+
+
+def process_pipeline_ticket(pipeline, query, ticket):
+    # The processors always run in the same order for a ticket, each call with its own retries
+    for processor in pipeline.get_processors(query):
+        name = type(processor).__name__
+        if pipeline.is_merged(ticket):
+            log.info('[#%s] Merged into another ticket, skipping the remaining processors', ticket['id'])
+            return True
+
+        if pipeline.is_unchanged(processor, ticket):
+            log.debug('[#%s] Unchanged since %s last looked at it', ticket['id'], name)
+            continue
+
+        result = process_ticket(processor, ticket)
+        if result:
+            # The ticket was resolved, merged or moved, so the remaining processors can skip it
+            log.debug('[#%s] Handled by %s', ticket['id'], name)
+            return True
+
+        if pipeline.memo is not None:
+            pipeline.memo.record(name, ticket, result)
+    return False
+
+
+@backoff.on_exception(backoff.expo, exceptions, max_tries=10)
+def load_pipeline(pipeline):
+    pipeline.load()
+
+
+def process_pipeline_ticket_safely(pipeline, query, ticket):
+    # Each processor call is already retried, so a ticket failing here keeps failing.
+    # Any error only defers this ticket, so one odd ticket can not block the rest of the batch.
+    if pipeline.is_stopped():
+        # Tickets already queued for the workers are left for the next run
+        return
+    try:
+        process_pipeline_ticket(pipeline, query, ticket)
+    except CircuitOpen as e:
+        # A service the processor needs is down. The processors that don't need it still run for the other tickets.
+        log.warning('[#%s] %s', ticket['id'], e)
+        pipeline.defer(ticket)
+    except Exception:
+        log.exception('[#%s] Failed to process ticket', ticket['id'])
+        pipeline.defer(ticket)
+
+
+def process_pipeline(pipeline, executor=None):
+    load_pipeline(pipeline)
+
+    if executor is None:
+        for query, ticket in pipeline.get_tickets():
+            process_pipeline_ticket_safely(pipeline, query, ticket)
+        return
+
+    # Process different tickets in parallel
+    futures = [executor.submit(process_pipeline_ticket_safely, pipeline, query, ticket)
+               for query, ticket in pipeline.get_tickets()]
+    for future in futures:
+        future.result()
+
+
+class Bot(object):
+    # Holds the RT and Alma sessions, caches and processors, so that they can be
+    # reused across runs in daemon mode.
+
+    def __init__(self):
+        self.stopped = threading.Event()
+        self.setup()
+
+    def setup(self):
+        # Build everything that depends on the settings, so that it can be rebuilt on SIGHUP
+        self.alma = Alma()
+        self.tracker = Tracker()
+        self.processors = get_processors(self.tracker, self.alma)
+
+        workers = int(os.getenv('RTBOT_WORKERS', 1))
+        self.executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+        self.watermarks = None
+        if os.getenv('RTBOT_INCREMENTAL', '0') == '1':
+            self.watermarks = Watermarks(default_path() or ':memory:',
+                                         full_sweep_interval=int(os.getenv('RTBOT_FULL_SWEEP_INTERVAL', 6 * 3600)))
+
+        self.memo = None
+        memo_ttl = int(os.getenv('RTBOT_MEMO_TTL', 86400))
+        if memo_ttl > 0:
+            self.memo = DecisionMemo(default_path() or ':memory:', ttl=memo_ttl)
+
+    def reload(self):
+        # Finish the writes and workers from the old settings before replacing them
+        self.tracker.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.setup()
+
+    def run(self):
+        self.tracker.start_run()
+        self.alma.quota.reset()
+        self.alma.start_run()
+
+        if os.getenv('RTBOT_PIPELINE', '1') == '1':
+            pipeline = Pipeline(self.tracker, self.processors, self.watermarks, self.stopped, self.memo)
+            process_pipeline(pipeline, self.executor)
+            for ticket_id in self.tracker.flush():
+                # The ticket is unchanged in RT, so it must be picked up again by the next run
+                pipeline.defer({'id': ticket_id})
+            pipeline.save_watermarks()
+            if pipeline.deferred:
+                log.warning('Deferred %d tickets to the next run: %s',
+                            len(pipeline.deferred), ', '.join(str(x) for x in pipeline.deferred))
+        else:
+            for processor in self.processors:
+                process_tickets(processor)
+            self.tracker.flush()
+
+        self.alma.quota.log_summary()
+        self.alma.cache.log_stats()
+        self.alma.cache.purge()
+        self.tracker.content_cache.log_stats()
+        self.tracker.content_cache.purge()
+        if self.memo is not None:
+            self.memo.purge()
+
+    def run_forever(self, interval, jitter):
+        reload = threading.Event()
+
+        def stop(signum, frame):
+            log.info('Received signal %d, stopping after the current ticket', signum)
+            self.stopped.set()
+
+        def hangup(signum, frame):
+            log.info('Received SIGHUP, reloading configuration before the next run')
+            reload.set()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, hangup)
+
+        log.info('Starting daemon, polling every %d seconds', interval)
+        while not self.stopped.is_set():
+            if reload.is_set():
+                reload.clear()
+                setup_logging()
+                load_settings(override=True)
+                self.reload()
+
+            try:
+                self.run()
+            except rt.AuthorizationError:
+                log.warning('RT session expired, logging in again')
+                self.tracker.relogin()
+            except Exception:
+                log.exception('Run failed')
+
+            self.stopped.wait(interval + random.uniform(0, jitter))
+
+        if self.executor is not None:
+            self.executor.shutdown()
+        log.info('Daemon stopped')
 
 
 def main():
-    alma = Alma()
-    tracker = Tracker()
+    setup_logging()
+    load_settings()
+
+    parser = argparse.ArgumentParser(description='Sort and resolve tickets in RT')
+    parser.add_argument('--daemon', action='store_true',
+                        help='keep running, and poll RT at a fixed interval')
+    parser.add_argument('--interval', type=float, default=float(os.getenv('RTBOT_POLL_INTERVAL', 30)),
+                        help='seconds between runs in daemon mode (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=float(os.getenv('RTBOT_POLL_JITTER', 5)),
+                        help='maximum random delay in seconds added to the interval (default: %(default)s)')
+    parser.add_argument('--import-items', metavar='FILE',
+                        help='build the local barcode index from an Alma item export (CSV or JSON) and exit')
+    parser.add_argument('--import-users', metavar='FILE',
+                        help='build the local user table from an Alma user export (CSV or JSON) and exit')
+    parser.add_argument('--incremental', action='store_true',
+                        help='with --import-users, only replace the users in the export file')
+    args = parser.parse_args()
+
+    if args.import_items:
+        ItemIndex(os.getenv('ALMA_ITEM_INDEX', 'alma_items.db')).import_file(args.import_items)
+        return
 
-    for processor in get_processors(tracker, alma):
-        process_tickets(processor)
+    if args.import_users:
+        UserIndex(os.getenv('ALMA_USER_INDEX', 'alma_users.db')).import_file(args.import_users, args.incremental)
+        return
+
+    bot = Bot()
+    if args.daemon:
+        bot.run_forever(args.interval, args.jitter)
+    else:
+        bot.run()
 
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,82 @@
+import logging
+import os
+import threading
+import time
+import requests
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    # Raised instead of calling a service that has been failing
+    pass
+
+
+class CircuitBreaker(object):
+    # Stop calling a service after `threshold` failures in a row. After `reset_timeout`
+    # seconds a single probe call is let through (half-open): if it succeeds the circuit
+    # closes again, otherwise it stays open for another `reset_timeout` seconds.
+    # Timeouts, connection errors and 5xx responses count as failures.
+
+    def __init__(self, name, threshold=5, reset_timeout=60):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, prefix, threshold=5, reset_timeout=60):
+        # Can be overridden with e.g. ALMA_BREAKER_THRESHOLD=5 and ALMA_BREAKER_RESET=60
+        return cls(prefix.lower(),
+                   int(os.getenv('%s_BREAKER_THRESHOLD' % prefix, threshold)),
+                   float(os.getenv('%s_BREAKER_RESET' % prefix, reset_timeout)))
+
+    def is_open(self):
+        return self.opened_at is not None
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if self.probing or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpen('%s is unavailable' % self.name)
+            log.info('Circuit %s is half-open, probing', self.name)
+            self.probing = True
+
+    def on_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                log.info('Circuit %s closed', self.name)
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def on_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                if not self.probing:
+                    log.warning('Circuit %s opened after %d failures', self.name, self.failures)
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    def call(self, method, *args, **kwargs):
+        self.before_call()
+        try:
+            res = method(*args, **kwargs)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+            self.on_failure()
+            raise
+        except Exception:
+            # Not a sign of the service being down, but let the next call probe again
+            with self.lock:
+                self.probing = False
+            raise
+        if res.status_code >= 500:
+            self.on_failure()
+        else:
+            self.on_success()
+        return res
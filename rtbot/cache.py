@@ -0,0 +1,95 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+def default_path():
+    # The SQLite file shared by the persistent caches, or None to only cache in memory
+    return os.getenv('RTBOT_CACHE', 'rtbot_cache.db') or None
+
+
+class Cache(object):
+    # A bounded in-memory LRU cache in front of an optional SQLite store.
+    # Values must be JSON serializable, and every entry expires after its TTL.
+
+    def __init__(self, name, maxsize=1000, path=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('''CREATE TABLE IF NOT EXISTS cache
+                (
+                    name text,
+                    key text,
+                    value text,
+                    expires real,
+                    PRIMARY KEY (name, key)
+                )''')
+            self.db.commit()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self.lock:
+            value, expires = self.memory.get(key, (MISSING, 0))
+            if value is not MISSING and expires > now:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return value
+
+            if self.db is not None:
+                row = self.db.execute('SELECT value, expires FROM cache WHERE name = ? AND key = ? AND expires > ?',
+                                      [self.name, key, now]).fetchone()
+                if row is not None:
+                    value, expires = json.loads(row[0]), row[1]
+                    self.remember(key, value, expires)
+                    self.hits += 1
+                    return value
+
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl):
+        expires = time.time() + ttl
+        with self.lock:
+            self.remember(key, value, expires)
+            if self.db is not None:
+                self.db.execute('INSERT OR REPLACE INTO cache (name, key, value, expires) VALUES (?,?,?,?)',
+                                [self.name, key, json.dumps(value), expires])
+                self.db.commit()
+
+    def remember(self, key, value, expires):
+        self.memory[key] = (value, expires)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def purge(self):
+        # Remove expired entries from the SQLite store
+        if self.db is not None:
+            with self.lock:
+                self.db.execute('DELETE FROM cache WHERE name = ? AND expires <= ?', [self.name, time.time()])
+                self.db.commit()
+
+    def clear(self):
+        # Remove all entries, also from the SQLite store
+        with self.lock:
+            self.memory.clear()
+            if self.db is not None:
+                self.db.execute('DELETE FROM cache WHERE name = ?', [self.name])
+                self.db.commit()
+
+    def log_stats(self):
+        log.info('Cache %s: %d hits, %d misses', self.name, self.hits, self.misses)
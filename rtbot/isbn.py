@@ -0,0 +1,42 @@
+import re
+
+
+def clean_isbn(value):
+    # Remove hyphens and spaces, and use upper case X as check digit
+    return re.sub(r'[\s-]', '', value).upper()
+
+
+def is_valid_isbn10(isbn):
+    if not re.match(r'^[0-9]{9}[0-9X]$', isbn):
+        return False
+    total = sum((10 - n) * (10 if c == 'X' else int(c)) for n, c in enumerate(isbn))
+    return total % 11 == 0
+
+
+def is_valid_isbn13(isbn):
+    if not re.match(r'^97[89][0-9]{10}$', isbn):
+        return False
+    total = sum((3 if n % 2 else 1) * int(c) for n, c in enumerate(isbn))
+    return total % 10 == 0
+
+
+def to_isbn13(value):
+    # Return the ISBN-13 form of an ISBN-10 or ISBN-13, or None if it is not a valid ISBN
+    isbn = clean_isbn(value)
+    if is_valid_isbn13(isbn):
+        return isbn
+    if is_valid_isbn10(isbn):
+        isbn = '978' + isbn[:9]
+        check = (10 - sum((3 if n % 2 else 1) * int(c) for n, c in enumerate(isbn)) % 10) % 10
+        return isbn + str(check)
+    return None
+
+
+def normalize_isbns(values):
+    # Convert a list of ISBNs to ISBN-13, dropping invalid ones and duplicates, but keeping the order
+    isbns = []
+    for value in values:
+        isbn = to_isbn13(value)
+        if isbn is not None and isbn not in isbns:
+            isbns.append(isbn)
+    return isbns
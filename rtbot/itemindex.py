@@ -0,0 +1,79 @@
+import csv
+import json
+import logging
+import sqlite3
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def normalize_key(key):
+    # 'Library Code' => 'library_code'
+    return key.strip().lower().replace(' ', '_')
+
+
+def read_items(filename):
+    # Read (barcode, library code, library name, location name) rows from an Alma item export.
+    # CSV files need the columns Barcode, Library Code, Library Name and Location Name.
+    # JSON files contain a list of either such flat objects or Alma API item records.
+    with open(filename, encoding='utf-8') as fp:
+        if filename.endswith('.json'):
+            records = json.load(fp)
+        else:
+            records = csv.DictReader(fp)
+
+        for record in records:
+            if 'item_data' in record:
+                item_data = record['item_data']
+                yield (item_data['barcode'],
+                       item_data['library']['value'],
+                       item_data['library'].get('desc'),
+                       item_data.get('location', {}).get('desc'))
+                continue
+            record = {normalize_key(k): v for k, v in record.items()}
+            if record.get('barcode'):
+                yield (record['barcode'],
+                       record['library_code'],
+                       record.get('library_name'),
+                       record.get('location_name'))
+
+
+class ItemIndex(object):
+    # Local barcode => owning library index, built from a periodic Alma item export.
+    # Stored as an SQLite table without rowids, so the data lives in the primary key b-tree.
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS items
+            (
+                barcode text PRIMARY KEY,
+                library_code text,
+                library_name text,
+                location_name text
+            ) WITHOUT ROWID''')
+        self.db.commit()
+
+    def import_file(self, filename):
+        # Replace the index with the contents of an export file
+        with self.lock:
+            with self.db:
+                self.db.execute('DELETE FROM items')
+                self.db.executemany('INSERT OR REPLACE INTO items (barcode, library_code, library_name, location_name) '
+                                    'VALUES (?,?,?,?)', read_items(filename))
+            count = self.db.execute('SELECT COUNT(*) FROM items').fetchone()[0]
+        log.info('Imported %d items from %s', count, filename)
+        return count
+
+    def lookup(self, barcode):
+        # Return the item in the same shape as `item_data` from the Alma API, or None
+        with self.lock:
+            row = self.db.execute('SELECT library_code, library_name, location_name FROM items WHERE barcode = ?',
+                                  [barcode]).fetchone()
+        if row is None:
+            return None
+        return {
+            'barcode': barcode,
+            'library': {'value': row[0], 'desc': row[1]},
+            'location': {'desc': row[2]},
+        }
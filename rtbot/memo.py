@@ -0,0 +1,51 @@
+import logging
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class DecisionMemo(object):
+    # Remembers which processors did nothing with a ticket, keyed by the ticket's
+    # LastUpdated value, so that unchanged tickets are not analysed again on every
+    # run. Entries expire after `ttl` seconds.
+
+    def __init__(self, path, ttl=86400):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS decisions
+            (
+                processor text,
+                ticket_id integer,
+                last_updated text,
+                outcome text,
+                expires real,
+                PRIMARY KEY (processor, ticket_id)
+            )''')
+        self.db.commit()
+
+    def is_unchanged(self, processor, ticket):
+        # True if the processor already did nothing with this version of the ticket
+        if not ticket.get('LastUpdated'):
+            return False
+        with self.lock:
+            row = self.db.execute('SELECT 1 FROM decisions WHERE processor = ? AND ticket_id = ? '
+                                  'AND last_updated = ? AND expires > ?',
+                                  [processor, ticket['id'], ticket['LastUpdated'], time.time()]).fetchone()
+        return row is not None
+
+    def record(self, processor, ticket, outcome):
+        if not ticket.get('LastUpdated'):
+            return
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO decisions (processor, ticket_id, last_updated, outcome, expires) '
+                            'VALUES (?,?,?,?,?)',
+                            [processor, ticket['id'], ticket['LastUpdated'], repr(outcome), time.time() + self.ttl])
+            self.db.commit()
+
+    def purge(self):
+        with self.lock:
+            self.db.execute('DELETE FROM decisions WHERE expires <= ?', [time.time()])
+            self.db.commit()
@@ -0,0 +1,98 @@
+import logging
+from .processors.processor import describe_query
+from .watermark import parse_rt_date
+
+log = logging.getLogger(__name__)
+
+
+class Pipeline:
+    # Run a list of processors over a shared set of tickets. Identical queries
+    # are merged, so each ticket is fetched once and then passed through the
+    # processors in order until one of them handles it.
+
+    def __init__(self, rt, processors, watermarks=None, stopped=None, memo=None):
+        self.rt = rt
+        self.processors = processors
+        self.watermarks = watermarks
+        self.stopped = stopped
+        self.memo = memo
+
+        # Per-run state: the tickets found, and the ones deferred to the next run
+        self.tickets = []
+        self.newest = {}
+        self.deferred = []
+
+    def get_queries(self):
+        # Distinct queries, in the order they first appear in the processor list
+        queries = []
+        for processor in self.processors:
+            for query in processor.queries:
+                if query not in queries:
+                    queries.append(query)
+        return queries
+
+    def get_processors(self, query):
+        return [processor for processor in self.processors if query in processor.queries]
+
+    def load(self):
+        # Run the searches for this run. If a search fails, calling this again
+        # only repeats the searches that have not completed yet.
+        seen = set(ticket['id'] for query, ticket in self.tickets)
+        for n, query in enumerate(self.get_queries()):
+            if n in self.newest:
+                continue
+
+            search_query = dict(query)
+            since = self.watermarks.since(query) if self.watermarks is not None else None
+            if since is not None:
+                search_query['LastUpdated__gt'] = since
+
+            log.info('[Pipeline] Searching for %s', describe_query(search_query))
+            tickets = list(self.rt.search(search_query))
+            for processor in self.get_processors(query):
+                processor.prepare([ticket for ticket in tickets if not self.is_unchanged(processor, ticket)])
+
+            newest = None
+            for ticket in tickets:
+                last_updated = parse_rt_date(ticket.get('LastUpdated'))
+                if last_updated is not None and (newest is None or last_updated > newest):
+                    newest = last_updated
+
+                if ticket['id'] not in seen:
+                    seen.add(ticket['id'])
+                    self.tickets.append((query, ticket))
+            self.newest[n] = (since is None, newest)
+
+    def get_tickets(self):
+        # Yield the tickets found by load(), until the bot is stopped
+        for query, ticket in self.tickets:
+            if self.is_stopped():
+                return
+            yield query, ticket
+
+    def defer(self, ticket):
+        # A ticket that kept failing. It is left for the next run instead of blocking the batch.
+        log.warning('[#%s] Deferring ticket to the next run', ticket['id'])
+        self.deferred.append(ticket['id'])
+
+    def is_merged(self, ticket):
+        # A ticket merged into another one during this run no longer exists on its own in RT
+        return self.rt.is_merged(ticket['id'])
+
+    def is_unchanged(self, processor, ticket):
+        return self.memo is not None and self.memo.is_unchanged(type(processor).__name__, ticket)
+
+    def is_stopped(self):
+        return self.stopped is not None and self.stopped.is_set()
+
+    def save_watermarks(self):
+        # Call after all tickets from get_tickets() have been processed. Deferred tickets
+        # would fall below a new watermark, so it is only moved when there are none.
+        if self.deferred:
+            log.info('[Pipeline] Not updating watermarks, %d tickets were deferred', len(self.deferred))
+            return
+        if self.watermarks is not None and not self.is_stopped():
+            for n, query in enumerate(self.get_queries()):
+                if n in self.newest:
+                    full_sweep, newest = self.newest[n]
+                    self.watermarks.update(query, newest, full_sweep)
@@ -1,17 +1,35 @@
-from .autosort import AutoSort
-from .uia import MergeUiATickets
-from .autoreply import ResolveAutoReplies
-from .ccc import ResolveCccReceipts
-from .takeaway import TakeAway
+import importlib
 
+# Enabled processors, in the order they run. A processor module, and the
+# dependencies it needs, is only imported when the processor is enabled.
 processors = [
-    # TakeAway,
-    ResolveAutoReplies,
-    ResolveCccReceipts,
-    MergeUiATickets,
-    AutoSort,
+    # 'takeaway.TakeAway',
+    'autoreply.ResolveAutoReplies',
+    'ccc.ResolveCccReceipts',
+    'uia.MergeUiATickets',
+    'autosort.AutoSort',
 ]
 
+# Module of every processor class, so they can still be imported from this package
+modules = {
+    'AutoSort': 'autosort',
+    'MergeUiATickets': 'uia',
+    'ResolveAutoReplies': 'autoreply',
+    'ResolveCccReceipts': 'ccc',
+    'TakeAway': 'takeaway',
+}
+
+
+def load_processor(name):
+    module_name, class_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module('.' + module_name, __name__), class_name)
+
 
 def get_processors(*args, **kwargs):
-    return [cls(*args, **kwargs) for cls in processors]
+    return [load_processor(name)(*args, **kwargs) for name in processors]
+
+
+def __getattr__(name):
+    if name in modules:
+        return load_processor('%s.%s' % (modules[name], name))
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
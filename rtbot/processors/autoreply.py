@@ -1,6 +1,6 @@
-import re
 import logging
 from .processor import Processor
+from ..rules import find_rule
 
 log = logging.getLogger(__name__)
 
@@ -30,37 +30,14 @@ class ResolveAutoReplies(Processor):
         comment = "<p>Meldingen ble klassifisert som <strong>%s</strong> fordi %s.<p><p>Saken ble derfor automatisk lukket av rt-bot-modulen " % (category, reason) + \
             "<a href='https://github.com/scriptotek/rt-bot/blob/master/rtbot/processors/autoreply.py'>autoreply.py</a>.</p>" + \
             "<p>Ble meldingen feilklassifisert? Gi beskjed til Dan Michael.</p>"
-        if not self.rt.comment(ticket['id'], text=comment, content_type='text/html'):
-            log.error('[#%s] Failed to add comment to ticket!', ticket['id'])
-            return False
+        self.rt.queue_comment(ticket, comment, content_type='text/html')
 
         # Merk: Vi tømmer Requestors for å forhindre at en "Sak lukket (Resolved)"-melding sendes ut, siden disse kan føre til at mottakersystemet
         # sender et nytt autosvar og bringer oss inn i en endeløs løkke av autosvar.
-        if not self.rt.edit_ticket(ticket['id'], Status='resolved', Requestors=[]):
-            log.error('[#%s] Failed to auto-resolve ticket!', ticket['id'])
-            return False
+        self.rt.queue_edit(ticket, Status='resolved', Requestors=[])
         return True
 
     def process_ticket(self, ticket):
-        sender_email = ticket['Requestors'][0]
-
-        if re.search(r'(automatic reply|automatisk svar)', ticket['Subject'], re.I):
-            return self.autoresolve(
-                ticket,
-                "generelt autosvar",
-                "meldingens emne inneholder teksten «automatic reply» eller «automatisk svar»"
-            )
-
-        if re.search(r'Re: UiA INC.*- Notification Item Letter', ticket['Subject']):
-            return self.autoresolve(
-                ticket,
-                "autosvar fra UiA på Alma Notification Item Letter",
-                "meldingens emne inneholdt teksten «Re: UiA INC*- Notification Item Letter»"
-            )
-
-        if sender_email == 'uibhjelp-reply@uib.no' and re.search(r'\(.*\) Notification Item Letter', ticket['Subject']):
-            return self.autoresolve(
-                ticket,
-                "autosvar fra UBB på Alma Notification Item Letter",
-                "meldingens emne inneholdt teksten «Notification Item Letter» og avsender var uibhjelp-reply@uib.no"
-            )
+        rule, m = find_rule(ticket, 'autoresolve')
+        if rule is not None:
+            return self.autoresolve(ticket, rule.params['category'], rule.params['reason'])
@@ -1,7 +1,10 @@
 import logging
+import os
 import re
-from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
 from .processor import Processor
+from ..rules import classify, find_rule
+from ..barcodes import extract_barcodes
 
 log = logging.getLogger(__name__)
 
@@ -32,6 +35,38 @@ pattern_map = {
     'Teologisk bibliotek': 'ub-humsam-biblioteket',
 }
 
+# Rule actions of the processors that run before AutoSort and always handle the ticket
+handled_actions = ('autoresolve', 'ccc_receipt', 'takeaway')
+
+
+def overlaps(a, b):
+    # True if b can occur inside a, or start inside a and continue past its end
+    return b in a or any(a.endswith(b[:n]) for n in range(1, len(b)))
+
+
+class PatternMatcher(object):
+    # Find every literal pattern that occurs in a text using a single scan with
+    # one alternation regex. The scan only reports non-overlapping matches, so
+    # patterns that can overlap another pattern are checked separately if the
+    # scan did not find them.
+
+    def __init__(self, patterns):
+        self.patterns = list(patterns)
+        ordered = sorted(self.patterns, key=len, reverse=True)
+        self.regex = re.compile('|'.join(re.escape(pattern) for pattern in ordered))
+        self.overlapping = [b for b in self.patterns
+                            if any(a != b and overlaps(a, b) for a in self.patterns)]
+
+    def find_all(self, content):
+        found = set(match.group(0) for match in self.regex.finditer(content))
+        for pattern in self.overlapping:
+            if pattern not in found and pattern in content:
+                found.add(pattern)
+        return [pattern for pattern in self.patterns if pattern in found]
+
+
+pattern_matcher = PatternMatcher(pattern_map)
+
 # Map of library codes to RT queues
 libcode_map = {
     '1030011': 'ub-humsam-biblioteket',
@@ -86,21 +121,61 @@ class AutoSort(Processor):
         }
     ]
 
+    def __init__(self, rt, alma):
+        super().__init__(rt, alma)
+        # Evaluate all rules to include all comments, even when the decision is already made
+        self.explain = os.getenv('AUTOSORT_EXPLAIN', '0') == '1'
+
+        # Threads used to resolve the Alma lookups of a batch before processing it (0 to disable)
+        self.prefetch_workers = int(os.getenv('AUTOSORT_PREFETCH_WORKERS', 4))
+
+    def prepare(self, tickets):
+        # Make the Alma lookups of the whole batch concurrently before the tickets are
+        # processed. Each ticket only prefetches what get_suggestions will look up for it,
+        # and lookups shared by several tickets are only made once.
+        if self.prefetch_workers <= 0:
+            return
+        # Tickets that the processors before AutoSort resolve or move never get here
+        tickets = [ticket for ticket in tickets
+                   if not any(rule.action in handled_actions for rule, m in classify(ticket))]
+
+        log.info('[AutoSort] Prefetching Alma lookups for %d tickets', len(tickets))
+        with ThreadPoolExecutor(max_workers=self.prefetch_workers) as executor:
+            list(executor.map(self.prefetch_ticket, tickets))
+
+    def prefetch_ticket(self, ticket):
+        # Look up the barcodes in order until one gives a queue, like get_suggestions does,
+        # and the sender only if neither the barcodes nor the text patterns give one.
+        try:
+            content = self.get_plain_text_content(ticket)
+            explain = self.should_explain()
+            found = False
+            for barcode in extract_barcodes(content) if content is not None else []:
+                item_data = self.alma.get_item(barcode)
+                if item_data is not None and item_data['library']['value'] in libcode_map:
+                    found = True
+                    if not explain:
+                        break
+            if explain or not (found or pattern_matcher.find_all(content or '')):
+                self.alma.find_user(ticket['Requestors'][0])
+        except Exception as e:
+            # Failed lookups are made again (or deferred) when the ticket is processed
+            log.warning('[#%s] Prefetch failed: %s', ticket['id'], e)
+
+    def should_explain(self):
+        # The explanations are not worth the Alma calls when the quota is running low
+        return self.explain and not self.alma.quota.is_low()
+
     def suggest_from_alma_items(self, ticket_id, content):
         # Suggest a queue based on the owning library of any item barcodes found in the email body.
         rule_name = 'alma_items'
 
-        barcodes = re.findall(r'\b[0-9a-zA-Z]{9}\b', content)
-        barcodes = set([x for x in barcodes if re.search(r'[0-9]{4}', x)])
-
-        for barcode in re.findall(r'\bRS-47BIBSYSUBO[0-9]+\b', content):
-            barcodes.add(barcode)
+        barcodes = extract_barcodes(content)
 
         log.info('[#%s] Found %d possible item barcodes', ticket_id, len(barcodes))
 
         for barcode in barcodes:
-            response = self.alma.get_json('/items', params={'item_barcode': barcode})
-            item_data = response.get('item_data')
+            item_data = self.alma.get_item(barcode)
 
             if item_data is None:
                 log.info('[#%s] Invalid barcode: %s', ticket_id, barcode)
@@ -123,25 +198,20 @@ class AutoSort(Processor):
     def suggest_from_pattern_match(self, ticket_id, content):
         # Suggest a queue based on specific text patterns found the email body.
         rule_name = 'pattern_match'
-        for pattern, queue in pattern_map.items():
-            if re.search(pattern, content):
-                log.info('[#%d] Ticket content matched pattern "%s"', ticket_id, pattern)
-                yield {
-                    'rule': rule_name,
-                    'queue': queue,
-                    'comment': '- Meldingen inneholder teksten "%s"' % pattern,
-                }
+        for pattern in pattern_matcher.find_all(content):
+            log.info('[#%d] Ticket content matched pattern "%s"', ticket_id, pattern)
+            yield {
+                'rule': rule_name,
+                'queue': pattern_map[pattern],
+                'comment': '- Meldingen inneholder teksten "%s"' % pattern,
+            }
 
     def suggest_from_sender(self, ticket_id, email):
         # Suggest a queue based on the resource sharing library of the sender.
 
         rule_name = 'rs_library'
-        search_results = self.alma.get_json('/users', params={
-            'q': 'email~%s' % email,
-            'limit': 10,
-            'offset': 0,
-        })
-        if search_results['total_record_count'] == 0:
+        user_data = self.alma.find_user(email)
+        if user_data is None:
             yield {
                 'rule': rule_name,
                 'queue': None,
@@ -149,8 +219,7 @@ class AutoSort(Processor):
             }
         else:
 
-            primary_id = search_results['user'][0]['primary_id']
-            user_data = self.alma.get_json('/users/%s' % quote(primary_id))
+            primary_id = user_data['primary_id']
             user_group = user_data['user_group']['desc']
             user_group_code = int(user_data['user_group']['value'])
 
@@ -213,23 +282,30 @@ class AutoSort(Processor):
                 }
 
     def get_suggestions(self, ticket):
-        # Given a ticket id, generate a set of suggestions
-        suggestions = []
+        # Given a ticket id, generate a set of suggestions.
+        # The rules are evaluated lazily in the order of preference used by make_decision.
+        # As soon as one of them suggests a queue, the decision can not change, so the
+        # remaining (and most expensive) lookups are skipped unless self.explain is set.
         requestor_email = ticket['Requestors'][0]
-
-        # Generate suggestions from the resource sharing library of the sender
-        for suggestion in self.suggest_from_sender(ticket['id'], requestor_email):
-            suggestions.append(suggestion)
-
         content = self.get_plain_text_content(ticket)
+
+        rules = []
         if content is not None:
             # Generate suggestions from the document barcodes found in the text
-            for suggestion in self.suggest_from_alma_items(ticket['id'], content):
-                suggestions.append(suggestion)
+            rules.append(lambda: self.suggest_from_alma_items(ticket['id'], content))
 
             # Generate suggestions from pre-defined text pattern matches
-            for suggestion in self.suggest_from_pattern_match(ticket['id'], content):
+            rules.append(lambda: self.suggest_from_pattern_match(ticket['id'], content))
+
+        # Generate suggestions from the resource sharing library of the sender
+        rules.append(lambda: self.suggest_from_sender(ticket['id'], requestor_email))
+
+        suggestions = []
+        for rule in rules:
+            for suggestion in rule():
                 suggestions.append(suggestion)
+                if suggestion['queue'] is not None and not self.should_explain():
+                    return suggestions
 
         return suggestions
 
@@ -254,7 +330,8 @@ class AutoSort(Processor):
         return decision, comments
 
     def process_ticket(self, ticket):
-        if re.match('Submission to .+ has been delivered', ticket['Subject']) is not None:
+        rule, m = find_rule(ticket, 'takeaway')
+        if rule is not None:
             return False
 
         suggestions = self.get_suggestions(ticket)
@@ -272,14 +349,8 @@ class AutoSort(Processor):
             # To test without editing, uncomment the line below
             # return
 
-            if not self.rt.comment(ticket['id'], text=comment_body):
-                log.error('[#%s] Failed to add comment to ticket!', ticket['id'])
-                return False
-
-            if not self.rt.edit_ticket(ticket['id'], Queue=decision['queue']):
-                log.error('[#%s] Failed to move ticket!', ticket['id'])
-                return False
-
+            self.rt.queue_comment(ticket, comment_body)
+            self.rt.queue_edit(ticket, Queue=decision['queue'])
             return True
 
         log.info('[#%s] Did not find a suggestion for this ticket.', ticket['id'])
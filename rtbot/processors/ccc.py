@@ -1,5 +1,6 @@
 import logging
 from .processor import Processor
+from ..rules import find_rule
 
 log = logging.getLogger(__name__)
 
@@ -16,9 +17,8 @@ class ResolveCccReceipts(Processor):
     ]
 
     def process_ticket(self, ticket):
-        if ticket['Requestors'][0] == 'no-reply@copyright.com':
+        rule, m = find_rule(ticket, 'ccc_receipt')
+        if rule is not None:
             log.info('[#%s] Updating CCC ticket', ticket['id'])
-            if not self.rt.edit_ticket(ticket['id'], Status='resolved', CF_CccGetItNow='Ja'):
-                log.error('[#%s] Failed to update ticket!', ticket['id'])
-                return False
+            self.rt.queue_edit(ticket, Status='resolved', CF_CccGetItNow='Ja')
             return True
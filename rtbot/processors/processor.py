@@ -3,6 +3,10 @@ import logging
 log = logging.getLogger(__name__)
 
 
+def describe_query(query):
+    return ' AND '.join(['%s=%s' % (k, v) for k, v in query.items()])
+
+
 class Processor:
 
     queries = []
@@ -11,18 +15,14 @@ class Processor:
         self.rt = rt
         self.alma = alma
 
+    def prepare(self, tickets):
+        # Called with all tickets from a search before they are processed one by one
+        pass
+
     def get_tickets(self):
         for query in self.queries:
-            log.info('[%s] Searching for %s',
-                     type(self).__name__,
-                     ' AND '.join(['%s=%s' % (k, v) for k, v in query.items()]))
-            for ticket in self.rt.search(query):
-                ticket['FirstRequestor'] = self.rt.get_user(ticket['Requestors'][0])
-                yield ticket
+            log.info('[%s] Searching for %s', type(self).__name__, describe_query(query))
+            yield from self.rt.search(query)
 
     def get_plain_text_content(self, ticket):
-        # Loop through attachments and check their content
-        for n, att_info in enumerate(self.rt.get_attachments(ticket['id'])):
-            att = self.rt.get_attachment(ticket['id'], att_info[0])
-            if att['ContentType'] == 'text/plain':
-                return att['Content'].decode('utf-8')
+        return self.rt.get_plain_text_content(ticket['id'])
@@ -1,17 +1,29 @@
 import pydash
 import logging
 import re
+import os
 import sys
-import time
 import json
+import threading
+import functools
 from typing import Optional
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import sqlite3
 from .processor import Processor
+from ..rules import find_rule
+from ..ratelimit import TokenBucket, limit_session
+from ..cache import Cache, default_path
+from ..isbn import clean_isbn, normalize_isbns
+from ..breaker import CircuitBreaker, CircuitOpen
 
 log = logging.getLogger(__name__)
 
+# General settings
+DEFAULT_TIMEOUT = 30
+LSM_URL = 'https://ub-lsm.uio.no/alma/search'
+
 pickup_points = {
     'Humanities and Social Sciences Library': 'ub-humsam-biblioteket',
     'Law Library': 'ub-ujur',
@@ -25,105 +37,100 @@ pickup_points = {
 }
 
 
-def create_table() -> None:
-    conn = sqlite3.connect('takeaway_stats.db')
-    cur = conn.cursor()
-    cur.execute('''CREATE TABLE daily
-        (
-            request_date text,
-            request_code text,
-            selected_lib text,
-            request_count integer,
-            isbn_count integer
-        )'''
-    )
-    cur.execute('''CREATE TABLE requests
-        (
-            request_prefix text,
-            request_prefix_no int,
-            request_time text,
-            language text,
-            selected_lib text,
-            rs_lib text,
-            user_group text,
-            with_isbn text,
-            isbn_count integer,
-            isbn_bibs text,
-            code_prefix text,
-            code_no int
-        )'''
-    )
-    conn.commit()
-    conn.close()
-
-
-# create_table()
-
-
-def add_to_stats(
-        request_code_prefix: str,
-        request_date: str,
-        request_queue: str,
-        request_lang: Optional[str],
-        user_rs_library: Optional[str],
-        user_group: Optional[str],
-        has_isbn: bool,
-        isbn_count: int,
-        isbn_matching_libs: list
-) -> str:
-    now = datetime.now().strftime('%Y-%m-%d')
-    conn = sqlite3.connect('takeaway_stats.db')
-    cur = conn.cursor()
-
-    cur.execute("SELECT MAX(code_no) FROM requests WHERE code_prefix = ?", [
-        request_code_prefix,
-    ])
-    rows = cur.fetchall()
-    request_code_no = int(rows[0][0] or 0) + 1
-    request_code = request_code_prefix + '-%03d' % request_code_no
-
-    # Insert a row of data
-    cur.execute("INSERT INTO requests (code_prefix, code_no, request_time, language, selected_lib, rs_lib, user_group, with_isbn, isbn_count, isbn_bibs) VALUES (?,?,?,?,?,?,?,?,?,?)", [
-        request_code_prefix,
-        request_code_no,
-        request_date,
-        request_lang,
-        request_queue,
-        user_rs_library,
-        user_group,
-        '1' if has_isbn else '0',
-        isbn_count,
-        json.dumps(isbn_matching_libs)
-    ])
-    conn.commit()
-
-    cur.execute("SELECT request_count, isbn_count FROM daily WHERE request_date = ? AND selected_lib = ?", [
-        now,
-        request_queue,
-    ])
-    rows = cur.fetchall()
-    if len(rows) != 0:
-        request_count = int(rows[0][0]) + 1
-        isbn_count = int(rows[0][1]) + isbn_count
-        cur.execute("UPDATE daily SET request_count=?, isbn_count=? WHERE request_date = ? AND selected_lib = ?", [
-            request_count,
-            isbn_count,
-            now,
-            request_queue,
-        ])
-        conn.commit()
-    else:
-        cur.execute("INSERT INTO daily (request_date, selected_lib, request_count, isbn_count) VALUES (?,?,?,?)", [
-            now,
-            request_queue,
-            1,
-            isbn_count,
-        ])
-        conn.commit()
-
-    conn.close()
-
-    return request_code
+class Stats(object):
+    # Statistics for take away requests. Uses one long-lived connection in WAL mode,
+    # and allocates request codes in a transaction so that concurrent workers
+    # never hand out the same code.
+
+    def __init__(self, path: str = 'takeaway_stats.db') -> None:
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.create_tables()
+
+    def create_tables(self) -> None:
+        cur = self.conn.cursor()
+        cur.execute('''CREATE TABLE IF NOT EXISTS daily
+            (
+                request_date text,
+                request_code text,
+                selected_lib text,
+                request_count integer,
+                isbn_count integer
+            )'''
+        )
+        cur.execute('''CREATE TABLE IF NOT EXISTS requests
+            (
+                request_prefix text,
+                request_prefix_no int,
+                request_time text,
+                language text,
+                selected_lib text,
+                rs_lib text,
+                user_group text,
+                with_isbn text,
+                isbn_count integer,
+                isbn_bibs text,
+                code_prefix text,
+                code_no int
+            )'''
+        )
+        cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS requests_code ON requests (code_prefix, code_no)')
+        cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS daily_lib ON daily (request_date, selected_lib)')
+
+    def add(
+            self,
+            request_code_prefix: str,
+            request_date: str,
+            request_queue: str,
+            request_lang: Optional[str],
+            user_rs_library: Optional[str],
+            user_group: Optional[str],
+            has_isbn: bool,
+            isbn_count: int,
+            isbn_matching_libs: list
+    ) -> str:
+        now = datetime.now().strftime('%Y-%m-%d')
+
+        with self.lock:
+            cur = self.conn.cursor()
+            # Take the write lock up front, so other processes cannot allocate the same code
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                cur.execute("SELECT MAX(code_no) FROM requests WHERE code_prefix = ?", [
+                    request_code_prefix,
+                ])
+                request_code_no = int(cur.fetchone()[0] or 0) + 1
+                request_code = request_code_prefix + '-%03d' % request_code_no
+
+                # Insert a row of data
+                cur.execute("INSERT INTO requests (code_prefix, code_no, request_time, language, selected_lib, rs_lib, user_group, with_isbn, isbn_count, isbn_bibs) VALUES (?,?,?,?,?,?,?,?,?,?)", [
+                    request_code_prefix,
+                    request_code_no,
+                    request_date,
+                    request_lang,
+                    request_queue,
+                    user_rs_library,
+                    user_group,
+                    '1' if has_isbn else '0',
+                    isbn_count,
+                    json.dumps(isbn_matching_libs)
+                ])
+
+                cur.execute("INSERT INTO daily (request_date, selected_lib, request_count, isbn_count) VALUES (?,?,?,?) "
+                            "ON CONFLICT (request_date, selected_lib) DO UPDATE SET "
+                            "request_count = request_count + 1, isbn_count = isbn_count + excluded.isbn_count", [
+                    now,
+                    request_queue,
+                    1,
+                    isbn_count,
+                ])
+                cur.execute('COMMIT')
+            except Exception:
+                cur.execute('ROLLBACK')
+                raise
+
+        return request_code
 
 
 class TakeAway(Processor):
@@ -136,6 +143,25 @@ class TakeAway(Processor):
         }
     ]
 
+    def __init__(self, rt, alma):
+        super().__init__(rt, alma)
+        self.lsm_limiter = TokenBucket.from_env('LSM', 2, 5)
+        self.lsm_breaker = CircuitBreaker.from_env('LSM')
+        self.local = threading.local()
+        self.lookup_workers = int(os.getenv('TAKEAWAY_LOOKUP_WORKERS', 4))
+        self.isbn_cache = Cache('isbn', maxsize=1000, path=default_path())
+        self.isbn_ttl = int(os.getenv('TAKEAWAY_ISBN_CACHE_TTL', 3600))
+        self.stats = Stats(os.getenv('TAKEAWAY_STATS_DB', 'takeaway_stats.db'))
+
+    @property
+    def lsm_session(self) -> requests.Session:
+        # One session per lookup thread, so connections are kept alive and reused between lookups
+        if not hasattr(self.local, 'lsm_session'):
+            session = limit_session(requests.Session(), self.lsm_limiter)
+            session.get = functools.partial(session.get, timeout=DEFAULT_TIMEOUT)
+            self.local.lsm_session = session
+        return self.local.lsm_session
+
     def lookup_alma_user(self, feide_id: Optional[str], sender_email: str = None) -> Optional[dict]:
         if feide_id is None:
             return None
@@ -154,6 +180,9 @@ class TakeAway(Processor):
                     'fees': pydash.get(res, 'fees.value', 0),
                     'blocks': pydash.get(res, 'user_block', []),
                 }
+        except (CircuitOpen, requests.exceptions.HTTPError):
+            # Alma is down or throttling us, which is not the same as the user not being found
+            raise
         except:
             pass
 
@@ -166,14 +195,37 @@ class TakeAway(Processor):
                     log.info('User found in Alma: %s', sender_email)
                     user_id = pydash.get(res, 'user.0.primary_id')
                     return self.lookup_alma_user(user_id)
+            except (CircuitOpen, requests.exceptions.HTTPError):
+                raise
             except:
                 pass
 
-    def lookup_alma_item(self, isbn: str) -> dict:
-        res = requests.get('https://ub-lsm.uio.no/alma/search', params={
-            'query': 'alma.isbn=' + isbn,
-            'expand_items': 'true',
-        }).json()
+    def search_alma_isbn(self, isbn: str) -> dict:
+        isbn = clean_isbn(isbn)
+        res = self.isbn_cache.get(isbn)
+        if res is None:
+            response = self.lsm_breaker.call(self.lsm_session.get, LSM_URL, params={
+                'query': 'alma.isbn=' + isbn,
+                'expand_items': 'true',
+            })
+            # Error responses are not "Ingen treff", so raise instead of caching them
+            response.raise_for_status()
+            res = response.json()
+            self.isbn_cache.set(isbn, res, self.isbn_ttl)
+        return res
+
+    def lookup_alma_items(self, isbns: list) -> list:
+        # Look up all ISBNs concurrently, returning the results in the same order as the ISBNs
+        with ThreadPoolExecutor(max_workers=self.lookup_workers) as executor:
+            responses = list(executor.map(self.search_alma_isbn, isbns))
+        results = []
+        for isbn, res in zip(isbns, responses):
+            results.extend(self.lookup_alma_item(isbn, res))
+        return results
+
+    def lookup_alma_item(self, isbn: str, res: dict = None) -> dict:
+        if res is None:
+            res = self.search_alma_isbn(isbn)
 
         if not pydash.get(res, 'results.0.holdings.0') and not pydash.get(res, 'results.0.portfolios.0'):
             log.info('Zero results in Alma for IBSN: %s' % isbn)
@@ -286,11 +338,18 @@ class TakeAway(Processor):
         content = re.split('ISBN.(?:nummer|number)', content, 1)[1]
 
         content = content.replace('-', '')
-        return re.findall(r'\b(97[0-9xX]{11}|[0-9xX]{10})\b', content, re.MULTILINE)
+        matches = re.findall(r'\b(97[0-9xX]{11}|[0-9xX]{10})\b', content, re.MULTILINE)
+
+        # Drop invalid numbers and ISBN-10/ISBN-13 pairs of the same book before any lookups
+        isbns = normalize_isbns(matches)
+        if len(isbns) != len(matches):
+            log.info('Kept %d of %d ISBN candidates after validation', len(isbns), len(matches))
+        return isbns
 
     def process_ticket(self, ticket: dict) -> bool:
 
-        if re.match('Submission to .+ has been delivered', ticket['Subject']) is None:
+        rule, m = find_rule(ticket, 'takeaway')
+        if rule is None:
             return False
 
         log.info('[#%s] New take away request', ticket['id'])
@@ -391,11 +450,10 @@ class TakeAway(Processor):
         )
         if has_isbn:
             isbns = self.extract_isbns(content)
-            for isbn in isbns:
-                for alma_result in self.lookup_alma_item(isbn):
-                    alma_results.append(alma_result)
-                    for libnr in alma_result['libs']:
-                        isbn_libnrs.add(libnr)
+            for alma_result in self.lookup_alma_items(isbns):
+                alma_results.append(alma_result)
+                for libnr in alma_result['libs']:
+                    isbn_libnrs.add(libnr)
 
         log.info('Resultater funnet i følgende bibliotek: %s', ', '.join(list(isbn_libnrs)))
 
@@ -407,7 +465,7 @@ class TakeAway(Processor):
         comment_body.append(self.format_bib_results(alma_results))
 
         request_code_prefix = '%s' % datetime.now().strftime('%d')
-        request_code = add_to_stats(
+        request_code = self.stats.add(
             request_code_prefix=request_code_prefix,
             request_date=ticket['Created'],
             request_lang=user_data['language'],
@@ -421,14 +479,9 @@ class TakeAway(Processor):
 
         if len(comment_body):
             print('\n'.join(comment_body))
-            time.sleep(10)
-            if not self.rt.comment(ticket['id'], text='\n'.join(comment_body), content_type='text/html'):
-                log.error('[#%s] Failed to add comment to ticket!', ticket['id'])
-                return False
+            self.rt.queue_comment(ticket, '\n'.join(comment_body), content_type='text/html')
 
-        if not self.rt.edit_ticket(ticket['id'], Queue=queue, Subject='UiO Library takeaway request %s' % request_code):
-            log.error('[#%s] Failed to update ticket!', ticket['id'])
-            return False
+        self.rt.queue_edit(ticket, Queue=queue, Subject='UiO Library takeaway request %s' % request_code)
 
         # time.sleep(30)
         return True
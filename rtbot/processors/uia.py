@@ -1,11 +1,62 @@
-import re
 import rt
 import logging
+import sqlite3
+import threading
 from .processor import Processor
+from ..rules import find_rule
+from ..cache import default_path
+from ..util import process_id
 
 log = logging.getLogger(__name__)
 
 
+class UiAIndex(object):
+    # Persistent index of the RT tickets seen for each UiA INC number, and
+    # which of them have already been merged.
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS uia_tickets
+            (
+                inc text,
+                ticket_id integer,
+                merged_into integer,
+                PRIMARY KEY (inc, ticket_id)
+            )''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS uia_searched
+            (
+                inc text PRIMARY KEY
+            )''')
+        self.db.commit()
+
+    def is_searched(self, inc):
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM uia_searched WHERE inc = ?', [inc]).fetchone() is not None
+
+    def set_searched(self, inc):
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO uia_searched (inc) VALUES (?)', [inc])
+            self.db.commit()
+
+    def add(self, inc, ticket_id):
+        with self.lock:
+            self.db.execute('INSERT OR IGNORE INTO uia_tickets (inc, ticket_id) VALUES (?,?)', [inc, ticket_id])
+            self.db.commit()
+
+    def get(self, inc):
+        # Return a dict of ticket id => id of the ticket it was merged into (or None)
+        with self.lock:
+            rows = self.db.execute('SELECT ticket_id, merged_into FROM uia_tickets WHERE inc = ?', [inc]).fetchall()
+        return dict(rows)
+
+    def set_merged(self, inc, ticket_id, into):
+        with self.lock:
+            self.db.execute('UPDATE uia_tickets SET merged_into = ? WHERE inc = ? AND ticket_id = ?',
+                            [into, inc, ticket_id])
+            self.db.commit()
+
+
 class MergeUiATickets(Processor):
     # Merge tickets from the UiA support system with the same ticket ID
 
@@ -16,21 +67,59 @@ class MergeUiATickets(Processor):
         },
     ]
 
-    def merge(self, ticket, into):
-        log.info('Merging ticket %s into %s', ticket['id'], into['id'])
-        self.rt.merge_ticket(ticket['id'], into['id'])
+    def __init__(self, rt, alma):
+        super().__init__(rt, alma)
+        self.index = UiAIndex(default_path() or ':memory:')
+
+    def prepare(self, tickets):
+        # Add all UiA tickets of the batch to the index first, so that all
+        # duplicates of an INC number are merged at once.
+        for ticket in tickets:
+            rule, m = find_rule(ticket, 'uia_merge')
+            if rule is not None and not self.is_autoreply(ticket):
+                self.index.add(m.group(1), ticket['id'])
+
+    @staticmethod
+    def is_autoreply(ticket):
+        # Auto-replies are resolved instead. Merging one would send its resolve to the merged ticket.
+        return find_rule(ticket, 'autoresolve')[0] is not None
+
+    def merge(self, uia_ticket_id, ticket_id, into_id):
+        log.info('Merging ticket %s into %s', ticket_id, into_id)
+        if self.rt.merge_ticket(ticket_id, into_id):
+            self.index.set_merged(uia_ticket_id, ticket_id, into_id)
+        else:
+            log.error('[#%s] Failed to merge ticket into %s!', ticket_id, into_id)
 
     def process_ticket(self, ticket):
-        m = re.match('.*UiA (INC[0-9]+)', ticket['Subject'])
-        if m:
+        rule, m = find_rule(ticket, 'uia_merge')
+        if rule is not None and not self.is_autoreply(ticket):
             uia_ticket_id = m.group(1)
             log.info('UiA ticket ID: %s ', uia_ticket_id)
 
-            # Find all tickets with this ticket ID
-            tickets = sorted(self.rt.tracker.search(Queue=rt.ALL_QUEUES, Subject__like=uia_ticket_id), key=lambda x: x['id'])
+            known = self.index.get(uia_ticket_id)
+            if known.get(ticket['id']) is not None:
+                log.info('[#%s] Already merged into %s', ticket['id'], known[ticket['id']])
+                return True
+
+            self.index.add(uia_ticket_id, ticket['id'])
+            if not self.index.is_searched(uia_ticket_id):
+                # The first time we see this ID. Fall back to searching all queues once,
+                # in case there are older tickets the bot has not seen.
+                for ticket2 in self.rt.tracker.search(Queue=rt.ALL_QUEUES, Subject__like=uia_ticket_id):
+                    if not self.is_autoreply(ticket2):
+                        self.index.add(uia_ticket_id, process_id(ticket2['id']))
+                self.index.set_searched(uia_ticket_id)
+
+            # Merge all duplicates into the oldest ticket
+            known = self.index.get(uia_ticket_id)
+            into_id = min(known)
+            for ticket_id, merged_into in sorted(known.items()):
+                if ticket_id != into_id and merged_into is None:
+                    self.merge(uia_ticket_id, ticket_id, into_id)
 
-            for ticket2 in tickets[1:]:
-                self.merge(ticket2, tickets[0])
-            return True
+            # Only a ticket merged into another one is done. The oldest ticket stays open,
+            # so the remaining processors still sort it.
+            return self.index.get(uia_ticket_id).get(ticket['id']) is not None
 
         return False
@@ -0,0 +1,91 @@
+import logging
+import sqlite3
+import threading
+from collections import Counter
+from datetime import date
+from .breaker import CircuitOpen
+
+log = logging.getLogger(__name__)
+
+
+class QuotaExhausted(CircuitOpen):
+    # Raised instead of calling Alma when (almost) none of the daily quota is left
+    pass
+
+
+class Quota(object):
+    # Counts Alma API calls per endpoint, keeps daily totals in SQLite, and tracks
+    # the remaining daily quota reported in the X-Exl-Api-Remaining header. Calls are
+    # counted in memory, and only written to the database once per run.
+
+    def __init__(self, path, low=10000, critical=1000):
+        self.low = low
+        self.critical = critical
+        self.remaining = None
+        self.remaining_day = None
+        self.counts = Counter()
+        self.unsaved = Counter()
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS alma_calls
+            (
+                day text,
+                endpoint text,
+                calls integer,
+                PRIMARY KEY (day, endpoint)
+            )''')
+        self.db.commit()
+
+    def record(self, endpoint, res):
+        with self.lock:
+            self.counts[endpoint] += 1
+            self.unsaved[(date.today().isoformat(), endpoint)] += 1
+
+            remaining = res.headers.get('X-Exl-Api-Remaining')
+            if remaining is not None and remaining.isdigit():
+                self.remaining = int(remaining)
+                self.remaining_day = date.today()
+
+    def get_remaining(self):
+        # The quota resets every day, so forget what Alma told us yesterday
+        if self.remaining_day != date.today():
+            return None
+        return self.remaining
+
+    def is_low(self):
+        # Optional lookups should be skipped
+        remaining = self.get_remaining()
+        return remaining is not None and remaining < self.low
+
+    def is_exhausted(self):
+        # Leave what is left of the quota for other integrations using the same key
+        remaining = self.get_remaining()
+        return remaining is not None and remaining < self.critical
+
+    def save(self):
+        # Add the calls counted since the last save to the daily totals
+        with self.lock:
+            unsaved, self.unsaved = self.unsaved, Counter()
+            for (day, endpoint), calls in unsaved.items():
+                self.db.execute('INSERT INTO alma_calls (day, endpoint, calls) VALUES (?,?,?) '
+                                'ON CONFLICT (day, endpoint) DO UPDATE SET calls = calls + excluded.calls',
+                                [day, endpoint, calls])
+            self.db.commit()
+
+    def today(self):
+        with self.lock:
+            row = self.db.execute('SELECT SUM(calls) FROM alma_calls WHERE day = ?',
+                                  [date.today().isoformat()]).fetchone()
+        return row[0] or 0
+
+    def log_summary(self):
+        self.save()
+        log.info('Alma calls this run: %s. Today: %d. Remaining quota: %s',
+                 ', '.join('%s=%d' % (k, v) for k, v in sorted(self.counts.items())) or 'none',
+                 self.today(),
+                 'unknown' if self.get_remaining() is None else self.get_remaining())
+
+    def reset(self):
+        # Start counting a new run
+        with self.lock:
+            self.counts = Counter()
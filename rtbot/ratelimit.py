@@ -0,0 +1,47 @@
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+    # Allow up to `burst` calls at once, refilled at `rate` calls per second.
+    # Callers only block when the bucket is empty.
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, prefix, rate, burst):
+        # Budgets can be overridden with e.g. RT_RATE_LIMIT=2 and RT_RATE_BURST=10
+        return cls(float(os.getenv('%s_RATE_LIMIT' % prefix, rate)),
+                   int(os.getenv('%s_RATE_BURST' % prefix, burst)))
+
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                time.sleep((1 - self.tokens) / self.rate)
+
+
+def limit_session(session, bucket):
+    # Make every HTTP call made through a requests session take a token from the bucket
+    request = session.request
+
+    def limited_request(*args, **kwargs):
+        bucket.acquire()
+        return request(*args, **kwargs)
+
+    session.request = limited_request
+    return session
@@ -3,39 +3,158 @@ import sys
 import rt
 import functools
 import os
+import threading
 from .util import process_id
+from .ratelimit import TokenBucket, limit_session
+from .cache import Cache, default_path
+from .writer import Writer
 
 log = logging.getLogger(__name__)
 
 # General settings
 DEFAULT_TIMEOUT = 30
 
+# RT settings
+RT_URL = 'https://rt.uio.no/REST/1.0/'
+
+
+class Ticket(dict):
+    # A ticket from a search result. The RT user record of the first requestor
+    # is only fetched when FirstRequestor is read.
+
+    def __init__(self, tracker, data):
+        super().__init__(data)
+        self.tracker = tracker
+
+    def __missing__(self, key):
+        if key == 'FirstRequestor':
+            self[key] = self.tracker.get_user_memoized(self['Requestors'][0])
+            return self[key]
+        raise KeyError(key)
+
 
 class Tracker(object):
 
     def __init__(self):
+        self.limiter = TokenBucket.from_env('RT', 2, 10)
+        self.local = threading.local()
+        self.users = {}
+        self.user_locks = {}
+        self.merged = set()
+        self.lock = threading.Lock()
+
+        # Attachments are immutable in RT, so their contents can be cached. Ticket bodies contain
+        # personal data, so they are only written to RTBOT_CACHE if RT_CONTENT_CACHE_PERSIST=1.
+        persist = os.getenv('RT_CONTENT_CACHE_PERSIST', '0') == '1'
+        if not persist and default_path():
+            # Remove bodies stored while persistence was on
+            Cache('content', path=default_path()).clear()
+        self.content_cache = Cache('content', maxsize=int(os.getenv('RT_CONTENT_CACHE_SIZE', 200)),
+                                   path=default_path() if persist else None)
+        self.content_ttl = int(os.getenv('RT_CONTENT_CACHE_TTL', 7 * 86400))
 
-        # RT settings
-        RT_URL = 'https://rt.uio.no/REST/1.0/'
-        RT_USER = os.getenv('RT_USER')
-        RT_PASSWORD = os.getenv('RT_PASSWORD')
+        # Comments and edits are collected per ticket and written in the background
+        self.writer = Writer(self, background=os.getenv('RTBOT_WRITE_BEHIND', '1') == '1')
 
+        self.main_tracker = self.connect()
+        if not self.relogin():
+            sys.exit(1)
+        self.local.tracker = self.main_tracker
+
+    def connect(self):
         # Initialize RT tracker and add a default timeout
-        self.tracker = rt.Rt(RT_URL, RT_USER, RT_PASSWORD)
-        self.tracker.session.get = functools.partial(self.tracker.session.get, timeout=DEFAULT_TIMEOUT)
-        if self.tracker.login():
+        tracker = rt.Rt(RT_URL, os.getenv('RT_USER'), os.getenv('RT_PASSWORD'))
+        tracker.session.get = functools.partial(tracker.session.get, timeout=DEFAULT_TIMEOUT)
+        limit_session(tracker.session, self.limiter)
+        return tracker
+
+    def relogin(self):
+        # The worker clients share the cookie jar of the main client, so they are logged in too
+        if self.main_tracker.login():
             log.debug('RT login OK')
-        else:
-            log.error('RT login failed')
-            sys.exit(1)
+            return True
+        log.error('RT login failed')
+        return False
+
+    @property
+    def tracker(self):
+        # Requests sessions are not thread-safe, so each worker thread gets its own
+        # RT client, sharing the login cookies of the main one.
+        if not hasattr(self.local, 'tracker'):
+            tracker = self.connect()
+            tracker.session.cookies = self.main_tracker.session.cookies
+            tracker.login_result = self.main_tracker.login_result
+            self.local.tracker = tracker
+        return self.local.tracker
 
     def get_tracker(self):
         return self.tracker
 
+    def start_run(self):
+        # Forget the users looked up and the tickets merged during the previous run
+        self.users = {}
+        self.user_locks = {}
+        self.merged = set()
+
+    def get_user_memoized(self, email):
+        # Look up each RT user at most once per run, even with several worker threads
+        with self.lock:
+            lock = self.user_locks.setdefault(email, threading.Lock())
+        with lock:
+            if email not in self.users:
+                self.users[email] = self.get_user(email)
+            return self.users[email]
+
+    def get_plain_text_content(self, ticket_id):
+        # Return the first text/plain attachment of a ticket, downloading it only once
+        att_id = self.content_cache.get(str(ticket_id))
+        if att_id is not None:
+            content = self.content_cache.get('%s/%s' % (ticket_id, att_id))
+            if content is not None:
+                return content
+
+        for att_info in self.get_attachments(ticket_id) or []:
+            # Tuple format: (id, name, content_type, size)
+            if att_info[2] != 'text/plain':
+                continue
+            att = self.get_attachment(ticket_id, att_info[0])
+            if att['ContentType'] == 'text/plain':
+                content = att['Content'].decode('utf-8')
+                self.content_cache.set(str(ticket_id), att_info[0], self.content_ttl)
+                self.content_cache.set('%s/%s' % (ticket_id, att_info[0]), content, self.content_ttl)
+                return content
+
+    def queue_comment(self, ticket, text, content_type='text/plain'):
+        self.writer.comment(ticket, text, content_type)
+
+    def queue_edit(self, ticket, **fields):
+        self.writer.edit(ticket, **fields)
+
+    def submit(self, ticket_id):
+        self.writer.submit(ticket_id)
+
+    def discard(self, ticket_id):
+        self.writer.discard(ticket_id)
+
+    def flush(self):
+        return self.writer.flush()
+
+    def merge_ticket(self, ticket_id, into_id):
+        # Remember merged tickets, since RT applies any later change to them to the ticket they were merged into
+        if self.tracker.merge_ticket(ticket_id, into_id):
+            with self.lock:
+                self.merged.add(ticket_id)
+            return True
+        return False
+
+    def is_merged(self, ticket_id):
+        with self.lock:
+            return ticket_id in self.merged
+
     def search(self, query):
         for ticket in self.tracker.search(**query):
             ticket['id'] = process_id(ticket['id'])
-            yield ticket
+            yield Ticket(self, ticket)
 
     def __getattr__(self, name):
         def method(*args, **kwargs):
@@ -0,0 +1,74 @@
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+
+class Rule(object):
+    # A ticket classification rule: a regex on a ticket field and/or a required
+    # sender, and the action a processor should take when it matches.
+
+    def __init__(self, name, action, pattern=None, field='Subject', sender=None, flags=0, **params):
+        self.name = name
+        self.action = action
+        self.field = field
+        self.regex = re.compile(pattern, flags) if pattern is not None else None
+        self.sender = sender
+        self.params = params
+
+    def match(self, ticket, sender):
+        if self.sender is not None and sender != self.sender:
+            return None
+        if self.regex is None:
+            return True
+        return self.regex.search(ticket.get(self.field) or '')
+
+    def __repr__(self):
+        return '<Rule %s>' % self.name
+
+
+rules = [
+    Rule('automatic_reply', 'autoresolve',
+         pattern=r'(automatic reply|automatisk svar)',
+         flags=re.I,
+         category='generelt autosvar',
+         reason='meldingens emne inneholder teksten «automatic reply» eller «automatisk svar»'),
+    Rule('uia_notification_reply', 'autoresolve',
+         pattern=r'Re: UiA INC.*- Notification Item Letter',
+         category='autosvar fra UiA på Alma Notification Item Letter',
+         reason='meldingens emne inneholdt teksten «Re: UiA INC*- Notification Item Letter»'),
+    Rule('ubb_notification_reply', 'autoresolve',
+         pattern=r'\(.*\) Notification Item Letter',
+         sender='uibhjelp-reply@uib.no',
+         category='autosvar fra UBB på Alma Notification Item Letter',
+         reason='meldingens emne inneholdt teksten «Notification Item Letter» og avsender var uibhjelp-reply@uib.no'),
+    Rule('ccc_receipt', 'ccc_receipt',
+         sender='no-reply@copyright.com'),
+    Rule('uia_ticket', 'uia_merge',
+         pattern=r'^.*UiA (INC[0-9]+)'),
+    Rule('nettskjema_submission', 'takeaway',
+         pattern=r'^Submission to .+ has been delivered'),
+]
+
+
+def classify(ticket):
+    # Check all rules against a ticket once, and remember the (rule, match) pairs on the ticket
+    # so that every processor can reuse them.
+    if 'MatchedRules' not in ticket:
+        sender = ticket['Requestors'][0] if ticket.get('Requestors') else None
+        matched = []
+        for rule in rules:
+            m = rule.match(ticket, sender)
+            if m:
+                matched.append((rule, m))
+        ticket['MatchedRules'] = matched
+    return ticket['MatchedRules']
+
+
+def find_rule(ticket, action):
+    # Return the first (rule, match) pair with the given action, or (None, None)
+    for rule, m in classify(ticket):
+        if rule.action == action:
+            log.info('[#%s] Matched rule: %s', ticket['id'], rule.name)
+            return rule, m
+    return None, None
@@ -0,0 +1,33 @@
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight(object):
+    # Coalesce calls with the same key: while a call is running, other callers with
+    # the same key wait for its result instead of making the same call. Successful
+    # results are kept until clear() is called, failures are not.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.futures = {}
+
+    def do(self, key, method, *args):
+        with self.lock:
+            future = self.futures.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.futures[key] = future
+
+        if owner:
+            try:
+                future.set_result(method(*args))
+            except Exception as e:
+                with self.lock:
+                    del self.futures[key]
+                future.set_exception(e)
+        return future.result()
+
+    def clear(self):
+        with self.lock:
+            self.futures = {}
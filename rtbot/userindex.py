@@ -0,0 +1,94 @@
+import csv
+import json
+import logging
+import sqlite3
+import threading
+from .itemindex import normalize_key
+
+log = logging.getLogger(__name__)
+
+
+def read_users(filename):
+    # Read (email, primary id, user group code, user group, rs library code, rs library, campus code, campus)
+    # rows from an Alma user export. CSV files need the columns Email, Primary Identifier, User Group Code,
+    # User Group, RS Library Code, RS Library, Campus Code and Campus, with one row per email address.
+    # JSON files contain a list of Alma API user records, and give one row per email address of the user.
+    with open(filename, encoding='utf-8') as fp:
+        if filename.endswith('.json'):
+            for user in json.load(fp):
+                user_group = user.get('user_group') or {}
+                rs_library = (user.get('rs_library') or [{}])[0].get('code') or {}
+                campus_code = user.get('campus_code') or {}
+                if not user_group.get('value'):
+                    # Routing needs the user group, so leave these users to the Alma API
+                    continue
+                for email in (user.get('contact_info') or {}).get('email', []):
+                    yield (email['email_address'].lower(), user['primary_id'],
+                           user_group.get('value'), user_group.get('desc'),
+                           rs_library.get('value'), rs_library.get('desc'),
+                           campus_code.get('value'), campus_code.get('desc'))
+        else:
+            for record in csv.DictReader(fp):
+                record = {normalize_key(k): v or None for k, v in record.items()}
+                if record.get('email') and record.get('user_group_code'):
+                    yield (record['email'].lower(), record['primary_identifier'],
+                           record.get('user_group_code'), record.get('user_group'),
+                           record.get('rs_library_code'), record.get('rs_library'),
+                           record.get('campus_code'), record.get('campus'))
+
+
+class UserIndex(object):
+    # Local email address => Alma user table with just the fields sender based routing
+    # needs, built from a periodic Alma user export.
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS users
+            (
+                email text PRIMARY KEY,
+                primary_id text,
+                user_group_code text,
+                user_group text,
+                rs_library_code text,
+                rs_library text,
+                campus_code text,
+                campus text
+            ) WITHOUT ROWID''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS users_primary_id ON users (primary_id)')
+        self.db.commit()
+
+    def import_file(self, filename, incremental=False):
+        # Replace the table with the contents of an export file. An incremental import only
+        # replaces the users that are in the file, and keeps everyone else.
+        rows = list(read_users(filename))
+        with self.lock:
+            with self.db:
+                if incremental:
+                    self.db.executemany('DELETE FROM users WHERE primary_id = ?',
+                                        [(primary_id,) for primary_id in set(row[1] for row in rows)])
+                else:
+                    self.db.execute('DELETE FROM users')
+                self.db.executemany('INSERT OR REPLACE INTO users VALUES (?,?,?,?,?,?,?,?)', rows)
+        log.info('Imported %d email addresses from %s', len(rows), filename)
+        return len(rows)
+
+    def lookup(self, email):
+        # Return the user in the same shape as an Alma API user record (with only the
+        # fields we store), or None
+        with self.lock:
+            row = self.db.execute('SELECT primary_id, user_group_code, user_group, rs_library_code, rs_library, '
+                                  'campus_code, campus FROM users WHERE email = ?', [email.lower()]).fetchone()
+        if row is None or row[1] is None:
+            # Not in the table, or without the user group we need, so look it up in Alma
+            return None
+        user = {
+            'primary_id': row[0],
+            'user_group': {'value': row[1], 'desc': row[2]},
+            'rs_library': [],
+        }
+        if row[3] is not None:
+            user['rs_library'].append({'code': {'value': row[3], 'desc': row[4]}})
+        if row[5] is not None:
+            user['campus_code'] = {'value': row[5], 'desc': row[6]}
+        return user
@@ -0,0 +1,70 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+log = logging.getLogger(__name__)
+
+# Format of LastUpdated in RT REST 1.0 search results, and the format TicketSQL expects
+RT_DATE_FORMAT = '%a %b %d %H:%M:%S %Y'
+QUERY_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Go back a little from the watermark, so tickets updated in the same second as it are not missed
+OVERLAP = timedelta(seconds=60)
+
+
+def parse_rt_date(value):
+    try:
+        return datetime.strptime(value, RT_DATE_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+class Watermarks(object):
+    # Highest LastUpdated value seen per search query, so that a search only
+    # needs to return the tickets that changed since the previous run. Every
+    # `full_sweep_interval` seconds a query is searched in full instead, to
+    # catch anything the incremental searches missed.
+
+    def __init__(self, path, full_sweep_interval=6 * 3600):
+        self.full_sweep_interval = full_sweep_interval
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS watermarks
+            (
+                query text PRIMARY KEY,
+                last_updated text,
+                full_sweep real
+            )''')
+        self.db.commit()
+
+    @staticmethod
+    def key(query):
+        return json.dumps(query, sort_keys=True)
+
+    def since(self, query):
+        # Return the LastUpdated lower bound for a query, or None when a full search is due
+        with self.lock:
+            row = self.db.execute('SELECT last_updated, full_sweep FROM watermarks WHERE query = ?',
+                                  [self.key(query)]).fetchone()
+        if row is None or row[0] is None or time.time() - row[1] > self.full_sweep_interval:
+            return None
+        return (datetime.strptime(row[0], QUERY_DATE_FORMAT) - OVERLAP).strftime(QUERY_DATE_FORMAT)
+
+    def update(self, query, last_updated, full_sweep):
+        key = self.key(query)
+        with self.lock:
+            row = self.db.execute('SELECT last_updated, full_sweep FROM watermarks WHERE query = ?',
+                                  [key]).fetchone()
+            previous, swept = row if row is not None else (None, 0)
+            if last_updated is not None:
+                value = last_updated.strftime(QUERY_DATE_FORMAT)
+                if previous is None or value > previous:
+                    previous = value
+            if full_sweep:
+                swept = time.time()
+            self.db.execute('INSERT OR REPLACE INTO watermarks (query, last_updated, full_sweep) VALUES (?,?,?)',
+                            [key, previous, swept])
+            self.db.commit()
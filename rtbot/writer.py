@@ -0,0 +1,130 @@
+import logging
+import threading
+from collections import OrderedDict
+import backoff
+import requests
+import rt
+
+log = logging.getLogger(__name__)
+
+exceptions = (
+    requests.exceptions.RequestException,
+    rt.UnexpectedResponse,
+)
+
+
+class Mutations(object):
+    # The comments and field edits collected for one ticket
+
+    def __init__(self, ticket_id):
+        self.ticket_id = ticket_id
+        self.comments = []
+        self.fields = OrderedDict()
+        self.submitted = False
+
+
+class Writer(object):
+    # Write-behind queue for RT changes. Comments and field edits are collected per
+    # ticket, edits are merged into a single edit_ticket call (leaving out fields that
+    # already have the new value), and submitted tickets are written by a background
+    # thread with retries, so that reading the next tickets does not wait for them.
+
+    def __init__(self, tracker, background=True):
+        self.tracker = tracker
+        self.background = background
+        self.pending = OrderedDict()
+        self.cond = threading.Condition()
+        self.busy = False
+        self.thread = None
+        # Tickets whose changes could not be written since the last flush
+        self.failed = []
+
+    def get(self, ticket_id):
+        with self.cond:
+            if ticket_id not in self.pending:
+                self.pending[ticket_id] = Mutations(ticket_id)
+            return self.pending[ticket_id]
+
+    def comment(self, ticket, text, content_type='text/plain'):
+        self.get(ticket['id']).comments.append((text, content_type))
+
+    def edit(self, ticket, **fields):
+        mutations = self.get(ticket['id'])
+        for name, value in fields.items():
+            if name in ticket and ticket[name] == value and name not in mutations.fields:
+                log.debug('[#%s] %s is already %s', ticket['id'], name, value)
+                continue
+            mutations.fields[name] = value
+
+    def submit(self, ticket_id):
+        # Hand the changes for a ticket to the writer
+        if not self.background:
+            with self.cond:
+                mutations = self.pending.pop(ticket_id, None)
+            if mutations is not None and not self.write(mutations):
+                with self.cond:
+                    self.failed.append(ticket_id)
+            return
+
+        with self.cond:
+            if ticket_id in self.pending:
+                self.pending[ticket_id].submitted = True
+                self.cond.notify_all()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='rt-writer', daemon=True)
+                self.thread.start()
+
+    def discard(self, ticket_id):
+        with self.cond:
+            mutations = self.pending.get(ticket_id)
+            if mutations is not None and not mutations.submitted:
+                del self.pending[ticket_id]
+
+    def flush(self):
+        # Wait until all submitted changes are written, and return the ids of the tickets that failed
+        with self.cond:
+            while self.busy or any(m.submitted for m in self.pending.values()):
+                self.cond.wait()
+            failed, self.failed = self.failed, []
+        return failed
+
+    def run(self):
+        while True:
+            with self.cond:
+                mutations = None
+                while mutations is None:
+                    mutations = next((m for m in self.pending.values() if m.submitted), None)
+                    if mutations is None:
+                        self.cond.wait()
+                del self.pending[mutations.ticket_id]
+                self.busy = True
+            written = False
+            try:
+                written = self.write(mutations)
+            except Exception:
+                log.exception('[#%s] Failed to write changes to ticket!', mutations.ticket_id)
+            finally:
+                with self.cond:
+                    if not written:
+                        self.failed.append(mutations.ticket_id)
+                    self.busy = False
+                    self.cond.notify_all()
+
+    def write(self, mutations):
+        ticket_id = mutations.ticket_id
+        for text, content_type in mutations.comments:
+            if not self.retry(self.tracker.comment, ticket_id, text=text, content_type=content_type):
+                # Don't move or resolve a ticket without the comment explaining why
+                log.error('[#%s] Failed to add comment to ticket!', ticket_id)
+                return False
+
+        if mutations.fields:
+            if not self.retry(self.tracker.edit_ticket, ticket_id, **mutations.fields):
+                log.error('[#%s] Failed to update ticket!', ticket_id)
+                return False
+        return True
+
+    @staticmethod
+    @backoff.on_exception(backoff.expo, exceptions, max_tries=10)
+    def retry(method, *args, **kwargs):
+        return method(*args, **kwargs)
@@ -11,7 +11,6 @@ setup(name='rtbot',
       long_description=README,
       classifiers=[
           'Programming Language :: Python',
-          'Programming Language :: Python :: 3.6',
           'Programming Language :: Python :: 3.7',
           'Programming Language :: Python :: 3.8',
       ],
@@ -19,6 +18,7 @@ setup(name='rtbot',
       author_email='d.m.heggo@ub.uio.no',
       url='https://github.com/scriptotek/rtbot',
       license='MIT',
+      python_requires='>=3.7',
       install_requires=['python-dotenv',
                         'rt',
                         'requests',
@@ -26,5 +26,5 @@ setup(name='rtbot',
                         'backoff',
                         'pydash'],
       entry_points={'console_scripts': ['rtbot=rtbot.bot:main']},
-      packages=['rtbot']
+      packages=['rtbot', 'rtbot.processors']
       )
@@ -0,0 +1,59 @@
+from rtbot.isbn import clean_isbn, is_valid_isbn10, is_valid_isbn13, to_isbn13, normalize_isbns
+from rtbot.processors.takeaway import TakeAway
+
+
+def test_clean_isbn():
+    assert clean_isbn('0-8044-2957-x') == '080442957X'
+    assert clean_isbn(' 978 0 306 40615 7 ') == '9780306406157'
+
+
+def test_isbn10_check_digit():
+    assert is_valid_isbn10('0306406152')
+    assert not is_valid_isbn10('0306406153')
+
+
+def test_isbn10_check_digit_x():
+    assert is_valid_isbn10('080442957X')
+    assert not is_valid_isbn10('0804429570')
+    # X is only allowed as the check digit
+    assert not is_valid_isbn10('X804429573')
+
+
+def test_isbn13_check_digit():
+    assert is_valid_isbn13('9780306406157')
+    assert not is_valid_isbn13('9780306406158')
+    # Only the Bookland prefixes are ISBNs
+    assert not is_valid_isbn13('9770306406150')
+
+
+def test_to_isbn13():
+    assert to_isbn13('0-306-40615-2') == '9780306406157'
+    assert to_isbn13('080442957X') == '9780804429573'
+    assert to_isbn13('080442957x') == '9780804429573'
+    assert to_isbn13('978-0-306-40615-7') == '9780306406157'
+
+
+def test_to_isbn13_rejects_invalid():
+    # A ten digit phone number with country prefix
+    assert to_isbn13('4791234567') is None
+    assert to_isbn13('9780306406158') is None
+    assert to_isbn13('030640615') is None
+    assert to_isbn13('') is None
+
+
+def test_normalize_isbns():
+    values = ['9780804429573', '0-306-40615-2', '080442957X', '9780306406157', '4791234567']
+    assert normalize_isbns(values) == ['9780804429573', '9780306406157']
+
+
+def test_extract_isbns():
+    content = '\n'.join([
+        'Navn: Ola Nordmann',
+        'Telefon: 4791234567',
+        'ISBN-nummer',
+        '    * 0-306-40615-2',
+        '    * 978-0-306-40615-7',
+        '    * 9780306406158',
+        '    * 080442957X',
+    ])
+    assert TakeAway.extract_isbns(content) == ['9780306406157', '9780804429573']